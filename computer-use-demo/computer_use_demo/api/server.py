@@ -1,17 +1,24 @@
 from __future__ import annotations
 
 import asyncio
-import json
+import logging
 import os
+import queue
 import sqlite3
-import threading
-from dataclasses import dataclass
+import uuid
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Dict, Iterator, List, Optional, Set
+from urllib.parse import quote
 
-from fastapi import BackgroundTasks, FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+import orjson
+from fastapi import FastAPI, HTTPException, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel, Field
 
 from anthropic.types.beta import (
@@ -24,8 +31,11 @@ from computer_use_demo.tools.base import ToolResult
 from computer_use_demo.tools.groups import ToolVersion
 
 
+logger = logging.getLogger(__name__)
+
+
 # -----------------------------
-# SQLite persistence (thread-safe)
+# SQLite persistence (WAL, 1 writer / N readers)
 # -----------------------------
 
 
@@ -44,17 +54,84 @@ def _compute_db_path() -> Path:
 
 
 DB_PATH = _compute_db_path()
-_db_lock = threading.RLock()
+_READER_POOL_SIZE = min(8, os.cpu_count() or 1)
+_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA foreign_keys=ON",
+)
+
+
+class _Writer:
+    """Owns the single read/write connection; only the writer task touches it."""
+
+    def __init__(self) -> None:
+        self.conn: Optional[sqlite3.Connection] = None
+        self.queue: Optional[asyncio.Queue[Optional[tuple[WriteCommand, asyncio.Future[Any]]]]] = None
+        self.task: Optional[asyncio.Task[None]] = None
+
 
+_writer = _Writer()
+_readers: queue.Queue[sqlite3.Connection] = queue.Queue()
+_WRITE_BATCH_SIZE = 64
+# Dedicated threads for SQLite calls, kept off the default executor: one per reader
+# connection, plus a separate single thread so writer batches never wait behind reads.
+_db_executor = ThreadPoolExecutor(max_workers=_READER_POOL_SIZE, thread_name_prefix="db-read")
+_db_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
 
-def _with_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH.as_posix(), check_same_thread=False)
+
+def _open_conn(readonly: bool = False) -> sqlite3.Connection:
+    # Readers open the file with mode=ro so they never take the write path. Shared
+    # cache is deliberately not used: it swaps WAL's concurrent readers for table locks.
+    # isolation_level=None: transactions are managed explicitly with BEGIN IMMEDIATE
+    mode = "ro" if readonly else "rwc"
+    conn = sqlite3.connect(
+        f"file:{quote(DB_PATH.as_posix())}?mode={mode}", uri=True, check_same_thread=False, isolation_level=None
+    )
     conn.row_factory = sqlite3.Row
+    if not readonly:
+        conn.execute("PRAGMA journal_mode=WAL")
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
+async def _run_db(fn: Callable[..., Any], *args: Any) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, fn, *args)
+
+
+async def _run_db_write(fn: Callable[..., Any], *args: Any) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(_db_write_executor, fn, *args)
+
+
+@contextmanager
+def _transaction(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        # A failed COMMIT can leave the transaction open; never leave the writer inside one
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+@contextmanager
+def _with_read_conn() -> Iterator[sqlite3.Connection]:
+    conn = _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put(conn)
+
+
 def _init_db() -> None:
-    with _db_lock, _with_conn() as conn:
+    if _writer.conn is not None:
+        return
+    _writer.conn = _open_conn()
+    with _transaction(_writer.conn) as conn:
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS sessions (
@@ -79,13 +156,23 @@ def _init_db() -> None:
               id INTEGER PRIMARY KEY AUTOINCREMENT,
               session_id TEXT NOT NULL,
               role TEXT NOT NULL,
-              content_json TEXT NOT NULL,
+              content_json BLOB NOT NULL,
               created_at TEXT NOT NULL,
               FOREIGN KEY(session_id) REFERENCES sessions(id) ON DELETE CASCADE
             )
             """
         )
-        conn.commit()
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages(session_id, id)")
+    for _ in range(_READER_POOL_SIZE):
+        _readers.put(_open_conn(readonly=True))
+
+
+def _close_db() -> None:
+    while not _readers.empty():
+        _readers.get_nowait().close()
+    if _writer.conn is not None:
+        _writer.conn.close()
+        _writer.conn = None
 
 
 # -----------------------------
@@ -93,6 +180,10 @@ def _init_db() -> None:
 # -----------------------------
 
 
+_OUTBOX_SIZE = 1024
+_COALESCE_WINDOW_S = 0.005
+
+
 @dataclass
 class SessionState:
     id: str
@@ -107,11 +198,17 @@ class SessionState:
     token_efficient_tools_beta: bool
     api_key: str
     messages: List[BetaMessageParam]
-    is_running: bool = False
+    run_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    outbox: asyncio.Queue[Dict[str, Any]] = field(default_factory=lambda: asyncio.Queue(maxsize=_OUTBOX_SIZE))
+    loop: Optional[asyncio.AbstractEventLoop] = None
+    broadcaster: Optional[asyncio.Task[None]] = None
+    run_task: Optional[asyncio.Task[None]] = None
 
 
 SESSIONS: Dict[str, SessionState] = {}
-WS_CLIENTS: Dict[str, Set[WebSocket]] = {}
+# Subscriber tuples are replaced (copy-on-write) rather than mutated, so a
+# broadcast can iterate the current snapshot without copying it.
+WS_CLIENTS: Dict[str, tuple[WebSocket, ...]] = {}
 
 
 def _read_api_key_from_storage() -> str:
@@ -131,7 +228,7 @@ def _read_api_key_from_storage() -> str:
 # -----------------------------
 
 
-app = FastAPI(title="Computer Use Demo API", version="1.0.0")
+app = FastAPI(title="Computer Use Demo API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Evaluation rubric (exposed via /evaluation)
 EVALUATION_WEIGHTS: Dict[str, float] = {
@@ -141,6 +238,18 @@ EVALUATION_WEIGHTS: Dict[str, float] = {
     "documentation": 0.15,
 }
 
+# Constant endpoint bodies, encoded once. Only the bytes are cached: a Response
+# instance must not be shared because middleware mutates its headers in place.
+_HEALTH_BODY = orjson.dumps({"status": "ok"})
+_EVALUATION_BODY = orjson.dumps(
+    {
+        "weights": EVALUATION_WEIGHTS,
+        "weights_percent": {k: int(v * 100) for k, v in EVALUATION_WEIGHTS.items()},
+        "total": sum(EVALUATION_WEIGHTS.values()),
+    }
+)
+_VNC_URL_BODY = orjson.dumps({"url": "http://127.0.0.1:6080/vnc.html?resize=scale&autoconnect=1"})
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -161,6 +270,19 @@ async def _startup() -> None:
     except Exception:
         pass
     _init_db()
+    _start_writer()
+
+
+@app.on_event("shutdown")
+async def _shutdown() -> None:
+    # Stop runs and broadcasters first: a cancelled run still records its final
+    # status, which needs the writer to be alive.
+    tasks = [*_AGENT_TASKS, *(s.broadcaster for s in SESSIONS.values() if s.broadcaster is not None)]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await _stop_writer()
+    _close_db()
 
 
 # -----------------------------
@@ -205,74 +327,238 @@ class MessageResponse(BaseModel):
 # -----------------------------
 
 
-def _insert_session(s: SessionState) -> None:
-    with _db_lock, _with_conn() as conn:
-        conn.execute(
-            """
-            INSERT OR REPLACE INTO sessions (
-              id, created_at, provider, model, tool_version, system_prompt_suffix,
-              only_n_most_recent_images, output_tokens, thinking_enabled, thinking_budget,
-              token_efficient_tools_beta, status
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                s.id,
-                datetime.utcnow().isoformat(),
-                s.provider.value,
-                s.model,
-                s.tool_version,
-                s.system_prompt_suffix,
-                s.only_n_most_recent_images,
-                s.output_tokens,
-                1 if s.thinking_enabled else 0,
-                s.thinking_budget,
-                1 if s.token_efficient_tools_beta else 0,
-                "idle",
-            ),
-        )
-        conn.commit()
+@dataclass
+class InsertSession:
+    session: SessionState
 
 
-def _set_session_status(session_id: str, status: str) -> None:
-    with _db_lock, _with_conn() as conn:
-        conn.execute("UPDATE sessions SET status = ? WHERE id = ?", (status, session_id))
-        conn.commit()
+@dataclass
+class UpdateStatus:
+    session_id: str
+    status: str
 
 
-def _insert_message(session_id: str, role: str, content: Any) -> int:
-    created_at = datetime.utcnow().isoformat()
-    with _db_lock, _with_conn() as conn:
-        cur = conn.execute(
-            """
-            INSERT INTO messages (session_id, role, content_json, created_at)
-            VALUES (?, ?, ?, ?)
-            """,
-            (session_id, role, json.dumps(content), created_at),
-        )
-        conn.commit()
-        last_id = cur.lastrowid if cur.lastrowid is not None else 0
-        return int(last_id)
+# Message content is encoded by the caller before a command is queued, so content
+# that cannot be serialized fails that request alone rather than a writer batch.
+@dataclass
+class InsertMessage:
+    session_id: str
+    role: str
+    content_json: bytes
 
 
-def _get_messages(session_id: str) -> List[MessageResponse]:
-    with _db_lock, _with_conn() as conn:
-        rows = conn.execute(
-            "SELECT id, role, content_json, created_at FROM messages WHERE session_id = ? ORDER BY id ASC",
-            (session_id,),
+@dataclass
+class InsertMessages:
+    session_id: str
+    rows: List[tuple[str, bytes]]
+
+
+@dataclass
+class DeleteSession:
+    session_id: str
+
+
+WriteCommand = InsertSession | UpdateStatus | InsertMessage | InsertMessages | DeleteSession
+
+
+def _encode_content(content: Any) -> bytes:
+    return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+_HISTORY_PAGE_SIZE = 500
+_SQL_INSERT_MSG = "INSERT INTO messages (session_id, role, content_json, created_at) VALUES (?, ?, ?, ?)"
+
+
+def _insert_session(conn: sqlite3.Connection, s: SessionState, created_at: str) -> None:
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO sessions (
+          id, created_at, provider, model, tool_version, system_prompt_suffix,
+          only_n_most_recent_images, output_tokens, thinking_enabled, thinking_budget,
+          token_efficient_tools_beta, status
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            s.id,
+            created_at,
+            s.provider.value,
+            s.model,
+            s.tool_version,
+            s.system_prompt_suffix,
+            s.only_n_most_recent_images,
+            s.output_tokens,
+            1 if s.thinking_enabled else 0,
+            s.thinking_budget,
+            1 if s.token_efficient_tools_beta else 0,
+            "idle",
+        ),
+    )
+
+
+def _set_session_status(conn: sqlite3.Connection, session_id: str, status: str) -> None:
+    conn.execute("UPDATE sessions SET status = ? WHERE id = ?", (status, session_id))
+
+
+def _insert_message(
+    conn: sqlite3.Connection, session_id: str, role: str, content_json: bytes, created_at: str
+) -> int:
+    cur = conn.execute(_SQL_INSERT_MSG, (session_id, role, content_json, created_at))
+    last_id = cur.lastrowid if cur.lastrowid is not None else 0
+    return int(last_id)
+
+
+def _insert_messages_bulk(
+    conn: sqlite3.Connection, session_id: str, rows: List[tuple[str, bytes]], created_at: str
+) -> None:
+    if not rows:
+        return
+    prepared_rows = [(session_id, role, content_json, created_at) for role, content_json in rows]
+    conn.executemany(_SQL_INSERT_MSG, prepared_rows)
+
+
+def _delete_session(conn: sqlite3.Connection, session_id: str) -> None:
+    conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+    conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+
+def _apply_write(conn: sqlite3.Connection, cmd: WriteCommand, now: str) -> Any:
+    if isinstance(cmd, InsertSession):
+        return _insert_session(conn, cmd.session, now)
+    if isinstance(cmd, UpdateStatus):
+        return _set_session_status(conn, cmd.session_id, cmd.status)
+    if isinstance(cmd, InsertMessage):
+        return _insert_message(conn, cmd.session_id, cmd.role, cmd.content_json, now)
+    if isinstance(cmd, InsertMessages):
+        return _insert_messages_bulk(conn, cmd.session_id, cmd.rows, now)
+    return _delete_session(conn, cmd.session_id)
+
+
+def _apply_writes(commands: List[WriteCommand]) -> List[Any]:
+    """Run a batch of commands in one transaction; a failing command only rolls back itself."""
+    conn = _writer.conn
+    if conn is None:
+        raise RuntimeError("Database is not initialized")
+    results: List[Any] = []
+    now = datetime.utcnow().isoformat()
+    with _transaction(conn):
+        for cmd in commands:
+            conn.execute("SAVEPOINT write_cmd")
+            try:
+                results.append(_apply_write(conn, cmd, now))
+            except Exception as e:
+                conn.execute("ROLLBACK TO write_cmd")
+                results.append(e)
+            conn.execute("RELEASE write_cmd")
+    return results
+
+
+async def _writer_loop(q: asyncio.Queue[Optional[tuple[WriteCommand, asyncio.Future[Any]]]]) -> None:
+    stopping = False
+    while not stopping:
+        batch: List[tuple[WriteCommand, asyncio.Future[Any]]] = []
+        item = await q.get()
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= _WRITE_BATCH_SIZE or q.empty():
+                break
+            item = q.get_nowait()
+        stopping = item is None
+        if not batch:
+            continue
+        try:
+            results = await _run_db_write(_apply_writes, [cmd for cmd, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, fut), result in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+
+def _start_writer() -> None:
+    if _writer.task is not None:
+        return
+    _writer.queue = asyncio.Queue()
+    _writer.task = asyncio.create_task(_writer_loop(_writer.queue))
+
+
+async def _stop_writer() -> None:
+    if _writer.queue is None or _writer.task is None:
+        return
+    q = _writer.queue
+    await q.put(None)  # drain pending writes, then exit
+    await _writer.task
+    _writer.queue = None
+    _writer.task = None
+    # Anything queued behind the sentinel will never be written; fail it rather than hang
+    while not q.empty():
+        item = q.get_nowait()
+        if item is not None and not item[1].done():
+            item[1].set_exception(RuntimeError("Database writer is not running"))
+
+
+async def _submit_write(cmd: WriteCommand) -> Any:
+    if _writer.queue is None:
+        raise RuntimeError("Database writer is not running")
+    fut: asyncio.Future[Any] = asyncio.get_running_loop().create_future()
+    await _writer.queue.put((cmd, fut))
+    return await fut
+
+
+# content_json holds orjson-encoded bytes (BLOB). Rows written before that change
+# are TEXT; orjson.loads and orjson.Fragment accept either, so both read back alike.
+def _get_message_rows(session_id: str, after_id: int, limit: int) -> List[sqlite3.Row]:
+    with _with_read_conn() as conn:
+        return conn.execute(
+            "SELECT id, role, content_json, created_at FROM messages"
+            " WHERE session_id = ? AND id > ? ORDER BY id ASC LIMIT ?",
+            (session_id, after_id, limit),
         ).fetchall()
+
+
+def _get_messages(session_id: str, after_id: int = 0, limit: int = _HISTORY_PAGE_SIZE) -> List[MessageResponse]:
+    rows = _get_message_rows(session_id, after_id, limit)
     return [
         MessageResponse(
             id=row["id"],
             role=row["role"],
-            content=json.loads(row["content_json"]),
+            content=orjson.loads(row["content_json"]),
             created_at=row["created_at"],
         )
         for row in rows
     ]
 
 
+def _get_history_page(session_id: str, after_id: int) -> tuple[bytes, int, int]:
+    """Return one encoded history frame, the number of messages in it and the last message id.
+
+    A full page sets "more", telling the client another history frame follows.
+    """
+    rows = _get_message_rows(session_id, after_id, _HISTORY_PAGE_SIZE)
+    # content_json is already valid JSON, so embed it verbatim instead of parsing and re-encoding
+    payload = orjson.dumps(
+        {
+            "type": "history",
+            "messages": [
+                {
+                    "id": row["id"],
+                    "role": row["role"],
+                    "content": orjson.Fragment(row["content_json"]),
+                    "created_at": row["created_at"],
+                }
+                for row in rows
+            ],
+            "more": len(rows) == _HISTORY_PAGE_SIZE,
+        }
+    )
+    return payload, len(rows), rows[-1]["id"] if rows else after_id
+
+
 def _get_sessions() -> List[SessionResponse]:
-    with _db_lock, _with_conn() as conn:
+    with _with_read_conn() as conn:
         rows = conn.execute(
             "SELECT id, created_at, status, provider, model, tool_version FROM sessions ORDER BY created_at DESC"
         ).fetchall()
@@ -289,13 +575,6 @@ def _get_sessions() -> List[SessionResponse]:
     ]
 
 
-def _delete_session(session_id: str) -> None:
-    with _db_lock, _with_conn() as conn:
-        conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
-        conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
-        conn.commit()
-
-
 # -----------------------------
 # Utilities
 # -----------------------------
@@ -308,19 +587,76 @@ def _ensure_session_exists(session_id: str) -> SessionState:
     return s
 
 
+def _subscribe(session_id: str, ws: WebSocket) -> None:
+    WS_CLIENTS[session_id] = tuple(x for x in WS_CLIENTS.get(session_id, ()) if x is not ws) + (ws,)
+
+
+def _unsubscribe(session_id: str, ws: WebSocket) -> None:
+    clients = WS_CLIENTS.get(session_id)
+    if clients is not None:
+        WS_CLIENTS[session_id] = tuple(x for x in clients if x is not ws)
+
+
 async def _broadcast(session_id: str, event: Dict[str, Any]) -> None:
-    dead: List[WebSocket] = []
-    for ws in WS_CLIENTS.get(session_id, set()).copy():
-        try:
-            await ws.send_json(event)
-        except Exception:
-            dead.append(ws)
+    await _send_to_clients(session_id, _encode_content(event))
+
+
+async def _send_to_clients(session_id: str, payload: bytes) -> None:
+    clients = WS_CLIENTS.get(session_id, ())
+    if not clients:
+        return
+    results = await asyncio.gather(*(ws.send_bytes(payload) for ws in clients), return_exceptions=True)
+    dead = [ws for ws, result in zip(clients, results) if isinstance(result, BaseException)]
     for ws in dead:
         try:
             await ws.close()
         except Exception:
             pass
-        WS_CLIENTS.get(session_id, set()).discard(ws)
+        _unsubscribe(session_id, ws)
+
+
+def _enqueue_event(session: SessionState, event: Dict[str, Any]) -> None:
+    if session.outbox.full():
+        session.outbox.get_nowait()  # drop the oldest event rather than grow unbounded
+    session.outbox.put_nowait(event)
+
+
+def _publish(session: SessionState, event: Dict[str, Any]) -> None:
+    """Queue an event for the session's broadcaster; safe to call from any thread."""
+    if session.loop is None:
+        return
+    session.loop.call_soon_threadsafe(_enqueue_event, session, event)
+
+
+async def _broadcaster(session: SessionState) -> None:
+    while True:
+        events = [await session.outbox.get()]
+        # Give bursts a short window to accumulate so they go out as one frame
+        await asyncio.sleep(_COALESCE_WINDOW_S)
+        while not session.outbox.empty():
+            events.append(session.outbox.get_nowait())
+        # Encode events one by one so a bad event is dropped alone, not with its batch
+        payloads: List[bytes] = []
+        for event in events:
+            try:
+                payloads.append(_encode_content(event))
+            except orjson.JSONEncodeError:
+                logger.exception("Dropping unencodable %r event for session %s", event.get("type"), session.id)
+        if not payloads:
+            continue
+        if len(payloads) == 1:
+            payload = payloads[0]
+        else:
+            payload = orjson.dumps({"type": "batch", "events": [orjson.Fragment(p) for p in payloads]})
+        try:
+            await _send_to_clients(session.id, payload)
+        except Exception:
+            logger.exception("Failed to broadcast events for session %s", session.id)
+
+
+def _start_broadcaster(session: SessionState) -> None:
+    session.loop = asyncio.get_running_loop()
+    session.broadcaster = asyncio.create_task(_broadcaster(session))
 
 
 # -----------------------------
@@ -328,44 +664,54 @@ async def _broadcast(session_id: str, event: Dict[str, Any]) -> None:
 # -----------------------------
 
 
-async def _run_agent_for_session(session: SessionState) -> None:
-    if session.is_running:
+# Caps concurrent sampling loops across sessions; excess runs wait their turn.
+_AGENT_SEM = asyncio.Semaphore(4)
+# Strong references to in-flight runs so they are not garbage collected mid-flight.
+_AGENT_TASKS: Set[asyncio.Task[None]] = set()
+
+
+async def _run_with_lock(session: SessionState) -> None:
+    # No await between the check and the acquire, so at most one run starts per session
+    if session.run_lock.locked():
+        return
+    async with session.run_lock, _AGENT_SEM:
+        await _run_agent_for_session(session)
+
+
+def _schedule_run(session: SessionState) -> None:
+    if session.run_task is not None and not session.run_task.done():
         return
-    session.is_running = True
-    _set_session_status(session.id, "running")
+    task = asyncio.create_task(_run_with_lock(session))
+    session.run_task = task
+    _AGENT_TASKS.add(task)
+    task.add_done_callback(_AGENT_TASKS.discard)
 
-    async def _output_callback_async(block: BetaContentBlockParam) -> None:
-        await _broadcast(session.id, {"type": "assistant_block", "block": block})
 
+async def _run_agent_for_session(session: SessionState) -> None:
     def output_callback(block: BetaContentBlockParam) -> None:
-        asyncio.create_task(_output_callback_async(block))
-
-    async def _tool_output_callback_async(result: ToolResult, tool_id: str) -> None:
-        payload: Dict[str, Any] = {
-            "type": "tool_result",
-            "tool_use_id": tool_id,
-            "output": result.output,
-            "error": result.error,
-            "base64_image": result.base64_image,
-        }
-        await _broadcast(session.id, payload)
+        _publish(session, {"type": "assistant_block", "block": block})
 
     def tool_output_callback(result: ToolResult, tool_id: str) -> None:
-        asyncio.create_task(_tool_output_callback_async(result, tool_id))
+        _publish(
+            session,
+            {
+                "type": "tool_result",
+                "tool_use_id": tool_id,
+                "output": result.output,
+                "error": result.error,
+                "base64_image": result.base64_image,
+            },
+        )
 
     def api_response_callback(request, response, error) -> None:
         try:
             status = getattr(response, "status_code", None)
         except Exception:
             status = None
-        asyncio.create_task(
-            _broadcast(
-                session.id,
-                {"type": "api_exchange", "status": status, "error": str(error) if error else None},
-            )
-        )
+        _publish(session, {"type": "api_exchange", "status": status, "error": str(error) if error else None})
 
     try:
+        await _submit_write(UpdateStatus(session.id, "running"))
         messages_before = list(session.messages)
         updated_messages = await sampling_loop(
             system_prompt_suffix=session.system_prompt_suffix,
@@ -384,18 +730,20 @@ async def _run_agent_for_session(session: SessionState) -> None:
         )
 
         if updated_messages and len(updated_messages) > len(messages_before):
-            for idx in range(len(messages_before), len(updated_messages)):
-                msg = updated_messages[idx]
-                role = msg.get("role", "assistant")
-                content = msg.get("content", [])
-                _insert_message(session.id, role, content)
+            new_rows = [
+                (msg.get("role", "assistant"), _encode_content(msg.get("content", [])))
+                for msg in updated_messages[len(messages_before) :]
+            ]
+            await _submit_write(InsertMessages(session.id, new_rows))
         session.messages = updated_messages
-        await _broadcast(session.id, {"type": "done"})
+        _publish(session, {"type": "done"})
     except Exception as e:
-        await _broadcast(session.id, {"type": "error", "message": str(e)})
+        _publish(session, {"type": "error", "message": str(e)})
     finally:
-        session.is_running = False
-        _set_session_status(session.id, "idle")
+        try:
+            await _submit_write(UpdateStatus(session.id, "idle"))
+        except Exception:
+            logger.exception("Failed to mark session %s idle", session.id)
 
 
 # -----------------------------
@@ -404,27 +752,23 @@ async def _run_agent_for_session(session: SessionState) -> None:
 
 
 @app.get("/health")
-def health() -> Dict[str, str]:
-    return {"status": "ok"}
+async def health() -> Response:
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 
 @app.get("/evaluation")
-def evaluation() -> Dict[str, Any]:
-    return {
-        "weights": EVALUATION_WEIGHTS,
-        "weights_percent": {k: int(v * 100) for k, v in EVALUATION_WEIGHTS.items()},
-        "total": sum(EVALUATION_WEIGHTS.values()),
-    }
+async def evaluation() -> Response:
+    return Response(content=_EVALUATION_BODY, media_type="application/json")
 
 
 @app.get("/vnc-url")
-def vnc_url() -> Dict[str, str]:
-    return {"url": "http://127.0.0.1:6080/vnc.html?resize=scale&autoconnect=1"}
+async def vnc_url() -> Response:
+    return Response(content=_VNC_URL_BODY, media_type="application/json")
 
 
 @app.post("/sessions", response_model=SessionResponse)
 async def create_session(req: CreateSessionRequest) -> SessionResponse:
-    session_id = datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+    session_id = uuid.uuid4().hex
     api_key = _read_api_key_from_storage()
     if req.provider == APIProvider.ANTHROPIC and not api_key:
         raise HTTPException(status_code=400, detail="Missing ANTHROPIC_API_KEY or ~/.anthropic/api_key")
@@ -444,8 +788,9 @@ async def create_session(req: CreateSessionRequest) -> SessionResponse:
         messages=[],
     )
     SESSIONS[state.id] = state
-    WS_CLIENTS.setdefault(state.id, set())
-    await asyncio.to_thread(_insert_session, state)
+    WS_CLIENTS.setdefault(state.id, ())
+    _start_broadcaster(state)
+    await _submit_write(InsertSession(state))
     return SessionResponse(
         id=state.id,
         created_at=datetime.utcnow().isoformat(),
@@ -458,52 +803,71 @@ async def create_session(req: CreateSessionRequest) -> SessionResponse:
 
 @app.get("/sessions", response_model=List[SessionResponse])
 async def list_sessions() -> List[SessionResponse]:
-    return await asyncio.to_thread(_get_sessions)
+    return await _run_db(_get_sessions)
 
 
 @app.delete("/sessions/{session_id}")
 async def delete_session(session_id: str) -> Dict[str, str]:
-    SESSIONS.pop(session_id, None)
-    await asyncio.to_thread(_delete_session, session_id)
+    session = SESSIONS.pop(session_id, None)
+    if session is not None:
+        # Stop the sampling loop too, so it frees its _AGENT_SEM slot and never
+        # writes messages for a session that no longer exists
+        for task in (session.run_task, session.broadcaster):
+            if task is not None:
+                task.cancel()
+    await _submit_write(DeleteSession(session_id))
     return {"status": "deleted"}
 
 
 @app.get("/sessions/{session_id}/messages", response_model=List[MessageResponse])
-async def get_session_messages(session_id: str) -> List[MessageResponse]:
+async def get_session_messages(
+    session_id: str,
+    response: Response,
+    after_id: int = Query(default=0, ge=0),
+    limit: int = Query(default=_HISTORY_PAGE_SIZE, ge=1, le=_HISTORY_PAGE_SIZE),
+) -> List[MessageResponse]:
     _ensure_session_exists(session_id)
-    return await asyncio.to_thread(_get_messages, session_id)
+    messages = await _run_db(_get_messages, session_id, after_id, limit)
+    if len(messages) == limit:
+        # A full page may have more behind it; pass this value as after_id to fetch the next one
+        response.headers["X-Next-After-Id"] = str(messages[-1].id)
+    return messages
 
 
 @app.post("/sessions/{session_id}/messages")
-async def post_message(session_id: str, req: PostMessageRequest, background: BackgroundTasks) -> Dict[str, Any]:
+async def post_message(session_id: str, req: PostMessageRequest) -> Dict[str, Any]:
     session = _ensure_session_exists(session_id)
 
     user_block = BetaTextBlockParam(type="text", text=req.text)
     session.messages.append({"role": "user", "content": [user_block]})
-    await asyncio.to_thread(_insert_message, session_id, "user", [{"type": "text", "text": req.text}])
+    await _submit_write(InsertMessage(session_id, "user", _encode_content([{"type": "text", "text": req.text}])))
 
-    if not session.is_running:
-        background.add_task(_run_agent_for_session, session)
+    if not session.run_lock.locked():
+        _schedule_run(session)
 
     return {"status": "accepted"}
 
 
 @app.websocket("/ws/{session_id}")
-async def websocket_endpoint(websocket: WebSocket, session_id: str):
+async def websocket_endpoint(websocket: WebSocket, session_id: str, after_id: int = 0):
     await websocket.accept()
     if session_id not in SESSIONS:
         await websocket.send_json({"type": "error", "message": "Session not found"})
         await websocket.close()
         return
-    WS_CLIENTS.setdefault(session_id, set()).add(websocket)
+    _subscribe(session_id, websocket)
     try:
-        history = await asyncio.to_thread(_get_messages, session_id)
-        await websocket.send_json({"type": "history", "messages": [m.model_dump() for m in history]})
+        # Replay history after the client's last seen message id, one page per frame
+        while True:
+            payload, count, after_id = await _run_db(_get_history_page, session_id, after_id)
+            await websocket.send_bytes(payload)
+            if count < _HISTORY_PAGE_SIZE:
+                break
         while True:
             await websocket.receive_text()  # keepalive; ignore client messages
     except WebSocketDisconnect:
         pass
     finally:
-        WS_CLIENTS.get(session_id, set()).discard(websocket)
+        _unsubscribe(session_id, websocket)
 
 
@@ -7,7 +7,7 @@ set -e
 python http_server.py > /tmp/server_logs.txt 2>&1 &
 
 # Start FastAPI server that exposes the agent APIs
-PYTHONPATH=. python -m uvicorn computer_use_demo.api.server:app --host 0.0.0.0 --port 9000 > /tmp/api_stdout.log 2>&1 &
+PYTHONPATH=. python -m uvicorn computer_use_demo.api.server:app --host 0.0.0.0 --port 9000 --loop uvloop --http httptools > /tmp/api_stdout.log 2>&1 &
 
 echo "✨ Computer Use Demo is ready!"
 echo "➡️  Open http://localhost:8080 in your browser to begin"
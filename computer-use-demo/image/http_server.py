@@ -1,6 +1,8 @@
+import gzip
+import hashlib
 import os
 import socket
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 
 
 INDEX_HTML = """
@@ -63,6 +65,7 @@ INDEX_HTML = """
       const log = (m) => { const el = document.getElementById('log'); el.textContent += `\n${m}`; el.scrollTop = el.scrollHeight; };
       let sessionId = null;
       let ws = null;
+      const textDecoder = new TextDecoder();
       const API_BASE = `${location.protocol}//${location.hostname}:9000`;
       const VNC_BASE = `${location.protocol}//${location.hostname}:6080`;
       document.getElementById('vnc').src = `${VNC_BASE}/vnc.html?resize=scale&autoconnect=1&view_only=1`;
@@ -96,22 +99,27 @@ INDEX_HTML = """
           ws.onopen = () => {
             log('ws open');
           };
+          ws.binaryType = 'arraybuffer';
+          const handleEvent = (msg) => {
+            if (msg.type === 'batch') {
+              msg.events.forEach(handleEvent);
+            } else if (msg.type === 'history') {
+              log(`[history] ${msg.messages.length} messages`);
+            } else if (msg.type === 'assistant_block') {
+              log(`[assistant] ${JSON.stringify(msg.block)}`);
+            } else if (msg.type === 'tool_result') {
+              log(`[tool] ${msg.error ? 'ERROR: ' + msg.error : (msg.output || '(image)')}`);
+            } else if (msg.type === 'api_exchange') {
+              log(`[api] status=${msg.status} error=${msg.error}`);
+            } else if (msg.type === 'done') {
+              log(`[done]`);
+            } else if (msg.type === 'error') {
+              log(`[error] ${msg.message}`);
+            }
+          };
           ws.onmessage = (ev) => {
             try {
-              const msg = JSON.parse(ev.data);
-              if (msg.type === 'history') {
-                log(`[history] ${msg.messages.length} messages`);
-              } else if (msg.type === 'assistant_block') {
-                log(`[assistant] ${JSON.stringify(msg.block)}`);
-              } else if (msg.type === 'tool_result') {
-                log(`[tool] ${msg.error ? 'ERROR: ' + msg.error : (msg.output || '(image)')}`);
-              } else if (msg.type === 'api_exchange') {
-                log(`[api] status=${msg.status} error=${msg.error}`);
-              } else if (msg.type === 'done') {
-                log(`[done]`);
-              } else if (msg.type === 'error') {
-                log(`[error] ${msg.message}`);
-              }
+              handleEvent(JSON.parse(typeof ev.data === 'string' ? ev.data : textDecoder.decode(ev.data)));
             } catch (e) { log('ws parse error: ' + e.message) }
           };
           ws.onclose = () => log('ws closed');
@@ -145,17 +153,54 @@ INDEX_HTML = """
 """
 
 
-class HTTPServerV6(HTTPServer):
+_INDEX_BYTES = INDEX_HTML.encode("utf-8")
+_INDEX_GZ = gzip.compress(_INDEX_BYTES, 9)
+_INDEX_ETAG = f'"{hashlib.md5(_INDEX_BYTES).hexdigest()}"'
+_INDEX_GZ_ETAG = f'"{hashlib.md5(_INDEX_GZ).hexdigest()}"'
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    # An explicit "gzip" entry takes precedence over "*"; q=0 means "not acceptable"
+    qvalues = {}
+    for coding in accept_encoding.split(","):
+        name, *params = coding.split(";")
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[name.strip().lower()] = q
+    return qvalues.get("gzip", qvalues.get("*", 0.0)) > 0
+
+
+class HTTPServerV6(ThreadingHTTPServer):
     address_family = socket.AF_INET6
+    daemon_threads = True
 
 
 class RootHandler(SimpleHTTPRequestHandler):
     def do_GET(self):
         if self.path == "/" or self.path == "/index.html":
+            use_gzip = _accepts_gzip(self.headers.get("Accept-Encoding", ""))
+            body, etag = (_INDEX_GZ, _INDEX_GZ_ETAG) if use_gzip else (_INDEX_BYTES, _INDEX_ETAG)
+            if etag in (t.strip() for t in self.headers.get("If-None-Match", "").split(",")):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                return
             self.send_response(200)
             self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            if use_gzip:
+                self.send_header("Content-Encoding", "gzip")
             self.end_headers()
-            self.wfile.write(INDEX_HTML.encode("utf-8"))
+            self.wfile.write(body)
         else:
             # For everything else, serve files from static_content
             self.path = "/static_content" + (self.path if self.path.startswith('/') else '/' + self.path)
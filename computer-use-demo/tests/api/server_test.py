@@ -0,0 +1,382 @@
+import asyncio
+import threading
+import time
+from unittest import mock
+
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+
+from computer_use_demo.api import server
+
+
+@pytest.fixture(autouse=True)
+def temp_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "DB_PATH", tmp_path / "test.sqlite3")
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test-key")
+    monkeypatch.setattr(server, "_read_api_key_from_storage", lambda: "test-key")
+    yield
+    server.SESSIONS.clear()
+    server.WS_CLIENTS.clear()
+
+
+@pytest.fixture
+def client():
+    with TestClient(server.app) as c:
+        yield c
+
+
+def _make_session(session_id: str, **kwargs) -> server.SessionState:
+    return server.SessionState(
+        id=session_id,
+        provider=server.APIProvider.ANTHROPIC,
+        model="test-model",
+        tool_version="computer_use_20250124",
+        system_prompt_suffix="",
+        only_n_most_recent_images=None,
+        output_tokens=1024,
+        thinking_enabled=False,
+        thinking_budget=None,
+        token_efficient_tools_beta=False,
+        api_key="test-key",
+        messages=[],
+        **kwargs,
+    )
+
+
+def _create_session(client: TestClient) -> str:
+    res = client.post("/sessions", json={})
+    assert res.status_code == 200
+    return res.json()["id"]
+
+
+def _wait_until_idle(session_id: str, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while server.SESSIONS[session_id].run_lock.locked():
+        assert time.monotonic() < deadline, "agent run did not finish"
+        time.sleep(0.01)
+
+
+async def test_failing_write_does_not_fail_its_batch():
+    server._init_db()
+    server._start_writer()
+    try:
+        state = _make_session("a")
+        content = server._encode_content([{"type": "text", "text": "hi"}])
+        # All three land in one writer batch; the orphan message violates the foreign key
+        results = await asyncio.gather(
+            server._submit_write(server.InsertSession(state)),
+            server._submit_write(server.InsertMessage("missing", "user", content)),
+            server._submit_write(server.InsertMessage("a", "user", content)),
+            return_exceptions=True,
+        )
+    finally:
+        await server._stop_writer()
+        server._close_db()
+
+    assert results[0] is None
+    assert isinstance(results[1], server.sqlite3.IntegrityError)
+    assert isinstance(results[2], int)
+
+    server._init_db()
+    try:
+        assert [s.id for s in server._get_sessions()] == ["a"]
+        assert [m.content for m in server._get_messages("a")] == [
+            [{"type": "text", "text": "hi"}]
+        ]
+    finally:
+        server._close_db()
+
+
+def test_encode_content():
+    assert orjson.loads(server._encode_content([{1: "x"}])) == [{"1": "x"}]
+    with pytest.raises(TypeError):
+        server._encode_content([object()])
+
+
+def test_message_paging(client):
+    session_id = _create_session(client)
+    rows = [
+        ("user", server._encode_content([{"type": "text", "text": str(i)}]))
+        for i in range(1201)
+    ]
+    client.portal.call(server._submit_write, server.InsertMessages(session_id, rows))
+
+    res = client.get(f"/sessions/{session_id}/messages")
+    first = res.json()
+    assert len(first) == 500
+    assert res.headers["X-Next-After-Id"] == str(first[-1]["id"])
+    second = client.get(
+        f"/sessions/{session_id}/messages",
+        params={"after_id": res.headers["X-Next-After-Id"]},
+    ).json()
+    assert len(second) == 500
+    assert second[0]["id"] > first[-1]["id"]
+    res = client.get(
+        f"/sessions/{session_id}/messages",
+        params={"after_id": second[-1]["id"], "limit": 10},
+    )
+    assert [m["content"][0]["text"] for m in res.json()] == [
+        str(i) for i in range(1000, 1010)
+    ]
+    res = client.get(
+        f"/sessions/{session_id}/messages", params={"after_id": second[-1]["id"]}
+    )
+    assert len(res.json()) == 201
+    assert "X-Next-After-Id" not in res.headers
+    assert (
+        client.get(
+            f"/sessions/{session_id}/messages", params={"limit": 501}
+        ).status_code
+        == 422
+    )
+
+    with client.websocket_connect(f"/ws/{session_id}") as ws:
+        pages = [orjson.loads(ws.receive_bytes()) for _ in range(3)]
+    assert [p["type"] for p in pages] == ["history"] * 3
+    assert [len(p["messages"]) for p in pages] == [500, 500, 201]
+    assert [p["more"] for p in pages] == [True, True, False]
+    assert pages[2]["messages"][-1]["content"] == [{"type": "text", "text": "1200"}]
+
+    with client.websocket_connect(
+        f"/ws/{session_id}?after_id={pages[2]['messages'][-2]['id']}"
+    ) as ws:
+        page = orjson.loads(ws.receive_bytes())
+    assert [m["content"][0]["text"] for m in page["messages"]] == ["1200"]
+
+
+def test_duplicate_post_does_not_start_second_run(client):
+    calls = 0
+
+    async def fake_sampling_loop(**kwargs):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.2)
+        return kwargs["messages"]
+
+    session_id = _create_session(client)
+    with mock.patch.object(server, "sampling_loop", fake_sampling_loop):
+        assert (
+            client.post(
+                f"/sessions/{session_id}/messages", json={"text": "one"}
+            ).status_code
+            == 200
+        )
+        assert (
+            client.post(
+                f"/sessions/{session_id}/messages", json={"text": "two"}
+            ).status_code
+            == 200
+        )
+        time.sleep(0.05)
+        _wait_until_idle(session_id)
+
+    assert calls == 1
+
+
+def test_burst_is_sent_as_one_batch_frame(client):
+    async def fake_sampling_loop(**kwargs):
+        kwargs["output_callback"]({"type": "text", "text": "hi"})
+        kwargs["tool_output_callback"](server.ToolResult(output="out"), "tool-1")
+        kwargs["api_response_callback"](None, None, None)
+        return kwargs["messages"] + [
+            {"role": "assistant", "content": [{"type": "text", "text": "hi"}]}
+        ]
+
+    session_id = _create_session(client)
+    with mock.patch.object(server, "sampling_loop", fake_sampling_loop):
+        with client.websocket_connect(f"/ws/{session_id}") as ws:
+            assert orjson.loads(ws.receive_bytes()) == {
+                "type": "history",
+                "messages": [],
+                "more": False,
+            }
+            client.post(f"/sessions/{session_id}/messages", json={"text": "go"})
+            frame = orjson.loads(ws.receive_bytes())
+        _wait_until_idle(session_id)
+
+    assert frame["type"] == "batch"
+    assert [e["type"] for e in frame["events"][:3]] == [
+        "assistant_block",
+        "tool_result",
+        "api_exchange",
+    ]
+    assert frame["events"][1]["tool_use_id"] == "tool-1"
+
+
+def test_broadcast_accepts_non_str_keys(client):
+    session_id = _create_session(client)
+    with client.websocket_connect(f"/ws/{session_id}") as ws:
+        ws.receive_bytes()  # history
+        event = {"type": "assistant_block", "block": {"input": {1: "a"}}}
+        client.portal.call(server._broadcast, session_id, event)
+        assert orjson.loads(ws.receive_bytes()) == {
+            "type": "assistant_block",
+            "block": {"input": {"1": "a"}},
+        }
+
+
+def test_unencodable_event_does_not_stop_broadcaster(client):
+    session_id = _create_session(client)
+    session = server.SESSIONS[session_id]
+    with client.websocket_connect(f"/ws/{session_id}") as ws:
+        ws.receive_bytes()  # history
+        client.portal.call(server._publish, session, {"type": "bad", "block": object()})
+        time.sleep(0.05)
+        client.portal.call(server._publish, session, {"type": "done"})
+        assert orjson.loads(ws.receive_bytes()) == {"type": "done"}
+
+        # Inside a burst only the bad event is dropped
+        def publish_burst():
+            server._publish(
+                session, {"type": "api_exchange", "status": 200, "error": None}
+            )
+            server._publish(session, {"type": "bad", "block": object()})
+            server._publish(session, {"type": "done"})
+
+        client.portal.call(publish_burst)
+        frame = orjson.loads(ws.receive_bytes())
+    assert frame["type"] == "batch"
+    assert [e["type"] for e in frame["events"]] == ["api_exchange", "done"]
+    assert not session.broadcaster.done()
+
+
+async def test_writes_do_not_wait_behind_reads(monkeypatch):
+    server._init_db()
+    server._start_writer()
+    release = threading.Event()
+    try:
+        # Occupy every reader thread, then check that a write still completes
+        monkeypatch.setattr(server, "_get_sessions", lambda: release.wait(5))
+        reads = [
+            asyncio.ensure_future(server._run_db(server._get_sessions))
+            for _ in range(server._READER_POOL_SIZE + 1)
+        ]
+        await asyncio.wait_for(
+            server._submit_write(server.UpdateStatus("missing", "idle")), timeout=2
+        )
+    finally:
+        release.set()
+        await asyncio.gather(*reads)
+        await server._stop_writer()
+        server._close_db()
+
+
+def test_failed_commit_does_not_leave_transaction_open(tmp_path):
+    conn = server.sqlite3.connect(tmp_path / "t.sqlite3", isolation_level=None)
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute("CREATE TABLE p (id INTEGER PRIMARY KEY)")
+    conn.execute(
+        "CREATE TABLE c (p_id INTEGER REFERENCES p(id) DEFERRABLE INITIALLY DEFERRED)"
+    )
+    # A deferred foreign key violation only surfaces at COMMIT
+    with pytest.raises(server.sqlite3.IntegrityError):
+        with server._transaction(conn):
+            conn.execute("INSERT INTO c VALUES (1)")
+    assert not conn.in_transaction
+    with server._transaction(conn):
+        conn.execute("INSERT INTO p VALUES (1)")
+    assert conn.execute("SELECT count(*) FROM c").fetchone()[0] == 0
+
+
+def test_delete_cancels_running_agent(client):
+    started = []
+    cancelled = []
+
+    async def fake_sampling_loop(**kwargs):
+        started.append(True)
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    session_id = _create_session(client)
+    with mock.patch.object(server, "sampling_loop", fake_sampling_loop):
+        client.post(f"/sessions/{session_id}/messages", json={"text": "go"})
+        deadline = time.monotonic() + 5
+        while not started:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        session = server.SESSIONS[session_id]
+        assert client.delete(f"/sessions/{session_id}").status_code == 200
+        deadline = time.monotonic() + 5
+        while not session.run_task.done():
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    assert cancelled == [True]
+    assert server._AGENT_SEM._value == 4
+    assert client.get("/sessions").json() == []
+
+
+async def test_status_write_failure_is_reported_as_error_event():
+    session = _make_session("a", loop=asyncio.get_running_loop())
+    # The writer is not running, so the "running" status update raises
+    await server._run_agent_for_session(session)
+    await asyncio.sleep(0)
+    assert session.outbox.get_nowait() == {
+        "type": "error",
+        "message": "Database writer is not running",
+    }
+
+
+def test_concurrent_runs_are_capped(client, monkeypatch):
+    monkeypatch.setattr(server, "_AGENT_SEM", asyncio.Semaphore(4))
+    running = 0
+    peak = 0
+
+    async def fake_sampling_loop(**kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.1)
+        running -= 1
+        return kwargs["messages"]
+
+    session_ids = [_create_session(client) for _ in range(6)]
+    with mock.patch.object(server, "sampling_loop", fake_sampling_loop):
+        for session_id in session_ids:
+            client.post(f"/sessions/{session_id}/messages", json={"text": "go"})
+        time.sleep(0.05)
+        for session_id in session_ids:
+            _wait_until_idle(session_id)
+
+    assert peak == 4
+
+
+def test_shutdown_cancels_runs_and_broadcasters():
+    async def fake_sampling_loop(**kwargs):
+        await asyncio.sleep(30)
+
+    with mock.patch.object(server, "sampling_loop", fake_sampling_loop):
+        with TestClient(server.app) as client:
+            session_id = _create_session(client)
+            client.post(f"/sessions/{session_id}/messages", json={"text": "go"})
+            time.sleep(0.1)
+            session = server.SESSIONS[session_id]
+            assert session.run_lock.locked()
+
+    assert session.run_task.cancelled()
+    assert session.broadcaster.cancelled()
+    assert not server._AGENT_TASKS
+    server._init_db()
+    try:
+        assert [s.status for s in server._get_sessions()] == ["idle"]
+    finally:
+        server._close_db()
+
+
+def test_reader_connections_are_read_only(tmp_path, monkeypatch):
+    db_dir = tmp_path / "odd?dir#name%20"
+    db_dir.mkdir()
+    monkeypatch.setattr(server, "DB_PATH", db_dir / "test.sqlite3")
+    server._init_db()
+    try:
+        assert server.DB_PATH.exists()
+        with server._with_read_conn() as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            with pytest.raises(server.sqlite3.OperationalError, match="readonly"):
+                conn.execute("DELETE FROM sessions")
+    finally:
+        server._close_db()
@@ -0,0 +1,82 @@
+import gzip
+import importlib.util
+import threading
+import urllib.error
+import urllib.request
+from http.server import HTTPServer
+from pathlib import Path
+
+import pytest
+
+_spec = importlib.util.spec_from_file_location(
+    "http_server", Path(__file__).parents[2] / "image" / "http_server.py"
+)
+assert _spec and _spec.loader
+http_server = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(http_server)
+
+
+@pytest.fixture(scope="module")
+def base_url():
+    server = HTTPServer(("127.0.0.1", 0), http_server.RootHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def _get(url: str, **headers: str):
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        return urllib.request.urlopen(req)
+    except urllib.error.HTTPError as e:
+        return e
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        ("gzip", True),
+        ("GZIP; Q=1", True),
+        ("deflate, gzip;q=0.5", True),
+        ("*", True),
+        ("", False),
+        ("br", False),
+        ("gzip;q=0", False),
+        ("gzip;q=0.0, *", False),
+        ("*, gzip;q=0", False),
+        ("gzip;q=bogus", False),
+    ],
+)
+def test_accepts_gzip(accept_encoding, expected):
+    assert http_server._accepts_gzip(accept_encoding) is expected
+
+
+def test_index_gzip(base_url):
+    res = _get(f"{base_url}/", **{"Accept-Encoding": "gzip"})
+    assert res.status == 200
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert res.headers["ETag"] == http_server._INDEX_GZ_ETAG
+    body = res.read()
+    assert int(res.headers["Content-Length"]) == len(body)
+    assert gzip.decompress(body) == http_server._INDEX_BYTES
+
+
+def test_index_identity(base_url):
+    res = _get(f"{base_url}/", **{"Accept-Encoding": "gzip;q=0"})
+    assert res.status == 200
+    assert res.headers["Content-Encoding"] is None
+    assert res.headers["ETag"] == http_server._INDEX_ETAG
+    assert res.read() == http_server._INDEX_BYTES
+
+
+def test_index_not_modified_matches_served_encoding(base_url):
+    gz_etag = http_server._INDEX_GZ_ETAG
+    res = _get(f"{base_url}/", **{"Accept-Encoding": "gzip", "If-None-Match": gz_etag})
+    assert res.status == 304
+    assert res.headers["ETag"] == gz_etag
+    # The gzip validator must not validate the identity body
+    res = _get(f"{base_url}/", **{"If-None-Match": gz_etag})
+    assert res.status == 200
+    assert res.headers["ETag"] == http_server._INDEX_ETAG